@@ -4,13 +4,21 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 import os
+import time
+import hashlib
+import tempfile
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente
 load_dotenv()
 
+# Validade da cópia local (Parquet) dos dados do banco
+CACHE_VALIDADE_SEGUNDOS = 24 * 60 * 60
+# Incrementar quando o tratamento dos dados após a consulta mudar
+CACHE_VERSAO = 2
+
 # Configuração da página
 st.set_page_config(
     page_title="Análise Saúde Municipal - PNAHP & PNAES",
@@ -40,85 +48,155 @@ def conectar_banco():
     try:
         engine = create_engine(
             f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@"
-            f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+            f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}",
+            # Pool compartilhado entre as sessões do Streamlit: reaproveita
+            # conexões abertas e descarta as que o servidor já derrubou
+            pool_size=5,
+            max_overflow=10,
+            pool_pre_ping=True,
+            pool_recycle=300,
+            connect_args={"application_name": "saude_app"}
         )
         return engine
     except Exception as e:
         st.error(f"Erro na conexão: {e}")
         return None
 
+# Carregar população, PIB, internações (PNAHP) e procedimentos (PNAES)
+# numa única consulta: cada tabela é agregada uma vez no servidor e
+# os joins acontecem no Postgres, não no pandas. Definida uma vez no
+# módulo para o SQLAlchemy reaproveitar a compilação da consulta.
+# O LIMIT fica só na amostra de população: os demais CTEs são ligados a ela
+# pelo JOIN, e um LIMIT neles descartaria municípios arbitrários da amostra
+QUERY_DADOS = text("""
+WITH pop AS (
+    SELECT 
+        codigo_ibge,
+        populacao_total,
+        (populacao_60_mais::float / populacao_total) * 100 as percentual_idosos
+    FROM Censo_20222_Populacao_idade_Sexo 
+    WHERE populacao_total > 0
+    LIMIT 1000
+),
+pib AS (
+    SELECT codigo_ibge, pib_per_capita 
+    FROM pib_municipios 
+),
+aih AS (
+    SELECT 
+        codigo_ibge_municipio,
+        COUNT(*) as total_internacoes,
+        SUM(valor_aih) as gasto_internacao_total
+    FROM sus_aih 
+    WHERE codigo_ibge_municipio IN (SELECT codigo_ibge FROM pop)
+    GROUP BY codigo_ibge_municipio
+),
+proc AS (
+    SELECT 
+        codigo_ibge_municipio,
+        COUNT(*) as total_procedimentos
+    FROM sus_procedimento_ambulatorial 
+    WHERE codigo_ibge_municipio IN (SELECT codigo_ibge FROM pop)
+    GROUP BY codigo_ibge_municipio
+)
+SELECT 
+    pop.*,
+    pib.pib_per_capita,
+    aih.total_internacoes,
+    aih.gasto_internacao_total,
+    proc.total_procedimentos
+FROM pop
+LEFT JOIN pib USING (codigo_ibge)
+LEFT JOIN aih ON aih.codigo_ibge_municipio = pop.codigo_ibge
+LEFT JOIN proc ON proc.codigo_ibge_municipio = pop.codigo_ibge
+""")
+
+# Limites dos sliders, calculados uma vez junto com o carregamento dos dados
+def calcular_limites(dados):
+    """Menor e maior valor das colunas usadas nos sliders, ignorando valores ausentes"""
+    limites = {}
+    for coluna in ['percentual_idosos', 'pib_per_capita']:
+        valores = dados[coluna].to_numpy(dtype=np.float64)
+        limites[coluna] = (float(np.nanmin(valores)), float(np.nanmax(valores)))
+    return limites
+
 # Função para carregar dados REAIS
 @st.cache_data
 def carregar_dados_reais(_engine):
     """Carrega dados REAIS do banco de dados"""
     try:
-        # Carregar dados populacionais
-        query_populacao = """
-        SELECT 
-            codigo_ibge,
-            populacao_total,
-            populacao_60_mais,
-            (populacao_60_mais::float / populacao_total) * 100 as percentual_idosos
-        FROM Censo_20222_Populacao_idade_Sexo 
-        WHERE populacao_total > 0
-        LIMIT 1000
-        """
-        df_populacao = pd.read_sql(query_populacao, _engine)
+        # Cópia local em Parquet, nomeada pelo hash do banco, da consulta e da
+        # versão do tratamento: sobrevive a reinícios do Streamlit e é
+        # invalidada quando qualquer um deles muda
+        chave_cache = "\n".join([
+            _engine.url.render_as_string(hide_password=True),
+            QUERY_DADOS.text,
+            str(CACHE_VERSAO),
+        ])
+        hash_consulta = hashlib.sha256(chave_cache.encode()).hexdigest()[:16]
+        caminho_cache = os.path.join(tempfile.gettempdir(), f"saude_cache_{hash_consulta}.parquet")
+        if (os.path.exists(caminho_cache)
+                and time.time() - os.path.getmtime(caminho_cache) < CACHE_VALIDADE_SEGUNDOS):
+            try:
+                df_completo = pd.read_parquet(caminho_cache, engine='pyarrow')
+                return df_completo, calcular_limites(df_completo)
+            except Exception:
+                # Cópia ilegível: descarta e segue para a consulta ao banco
+                try:
+                    os.remove(caminho_cache)
+                except OSError:
+                    pass
         
-        # Carregar dados de PIB
-        query_pib = """
-        SELECT codigo_ibge, pib_per_capita 
-        FROM pib_municipios 
-        LIMIT 1000
-        """
-        df_pib = pd.read_sql(query_pib, _engine)
+        # Cursor no servidor: as linhas chegam em lotes, sem materializar
+        # todo o resultado em memória antes de montar o DataFrame. Fica no
+        # backend NumPy: os filtros usam .cat.codes e comparam to_numpy() direto
+        with _engine.connect().execution_options(stream_results=True) as conn:
+            chunks = pd.read_sql(QUERY_DADOS, conn, chunksize=50_000)
+            df_completo = pd.concat(chunks, ignore_index=True, copy=False)
         
-        # Carregar internações hospitalares (PNAHP)
-        query_internacoes = """
-        SELECT 
-            codigo_ibge_municipio,
-            COUNT(*) as total_internacoes,
-            AVG(valor_aih) as valor_medio_internacao
-        FROM sus_aih 
-        GROUP BY codigo_ibge_municipio
-        LIMIT 1000
-        """
-        df_internacoes = pd.read_sql(query_internacoes, _engine)
+        # Códigos IBGE têm 7 dígitos: int32 basta e ocupa metade da memória
+        df_completo['codigo_ibge'] = df_completo['codigo_ibge'].astype('int32')
+        # Um município por linha: se algum JOIN duplicar códigos (ex.: PIB de
+        # vários anos), falha aqui em vez de multiplicar as linhas em silêncio
+        df_completo.set_index('codigo_ibge', inplace=True, verify_integrity=True)
         
-        # Carregar procedimentos ambulatoriais (PNAES)
-        query_procedimentos = """
-        SELECT 
-            codigo_ibge_municipio,
-            COUNT(*) as total_procedimentos,
-            AVG(valor_procedimento) as valor_medio_procedimento
-        FROM sus_procedimento_ambulatorial 
-        GROUP BY codigo_ibge_municipio
-        LIMIT 1000
-        """
-        df_procedimentos = pd.read_sql(query_procedimentos, _engine)
+        # Calcular indicadores por habitante: a população é lida uma única vez
+        por_habitante = 1.0 / df_completo['populacao_total'].to_numpy(dtype=np.float64)
+        df_completo['internacoes_por_1000'] = df_completo['total_internacoes'].to_numpy(dtype=np.float64) * por_habitante * 1000
+        df_completo['procedimentos_por_1000'] = df_completo['total_procedimentos'].to_numpy(dtype=np.float64) * por_habitante * 1000
+        df_completo['gasto_internacao_per_capita'] = df_completo['gasto_internacao_total'].to_numpy(dtype=np.float64) * por_habitante
         
-        # Juntar todos os dados
-        df_completo = df_populacao.merge(
-            df_pib, on='codigo_ibge', how='left'
-        ).merge(
-            df_internacoes, 
-            left_on='codigo_ibge', 
-            right_on='codigo_ibge_municipio', 
-            how='left'
-        ).merge(
-            df_procedimentos,
-            left_on='codigo_ibge',
-            right_on='codigo_ibge_municipio',
-            how='left',
-            suffixes=('', '_proc')
-        )
+        # Reduzir a precisão numérica: contagens em inteiros menores, valores em
+        # float32. O downcast='float' do pandas não reduz valores monetários
+        # (exige erro < 5e-4), por isso a conversão é explícita
+        for coluna in ['populacao_total', 'total_internacoes', 'total_procedimentos']:
+            if df_completo[coluna].isna().any():
+                # Municípios sem registro no JOIN ficam NaN: não cabem em inteiro
+                df_completo[coluna] = pd.to_numeric(df_completo[coluna]).astype('float32')
+            else:
+                df_completo[coluna] = pd.to_numeric(df_completo[coluna], downcast='integer')
+        for coluna in ['pib_per_capita', 'percentual_idosos', 'gasto_internacao_total',
+                       'internacoes_por_1000', 'procedimentos_por_1000', 'gasto_internacao_per_capita']:
+            df_completo[coluna] = pd.to_numeric(df_completo[coluna]).astype('float32')
         
-        # Calcular indicadores por habitante
-        df_completo['internacoes_por_1000'] = (df_completo['total_internacoes'] / df_completo['populacao_total']) * 1000
-        df_completo['procedimentos_por_1000'] = (df_completo['total_procedimentos'] / df_completo['populacao_total']) * 1000
-        df_completo['gasto_internacao_per_capita'] = (df_completo['total_internacoes'] * df_completo['valor_medio_internacao']) / df_completo['populacao_total']
+        # Grava num arquivo temporário do mesmo diretório e troca de uma vez,
+        # para que nenhum leitor veja um Parquet pela metade
+        caminho_tmp = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(caminho_cache),
+                                             suffix='.tmp', delete=False) as arquivo_tmp:
+                caminho_tmp = arquivo_tmp.name
+            df_completo.to_parquet(caminho_tmp, engine='pyarrow', compression='zstd')
+            os.replace(caminho_tmp, caminho_cache)
+        except Exception:
+            # Sem cópia local o app continua funcionando, só consulta o banco de novo
+            if caminho_tmp and os.path.exists(caminho_tmp):
+                try:
+                    os.remove(caminho_tmp)
+                except OSError:
+                    pass
         
-        return df_completo
+        return df_completo, calcular_limites(df_completo)
         
     except Exception as e:
         st.error(f"Erro ao carregar dados: {e}")
@@ -130,24 +208,48 @@ def carregar_dados_exemplo():
     """Fallback com dados de exemplo se o banco falhar"""
     st.warning("⚠️ Usando dados de exemplo. Configure as credenciais do banco no arquivo .env")
     
-    np.random.seed(42)
+    rng = np.random.default_rng(42)
     n_municipios = 200
     
+    populacao_total = rng.integers(10000, 800000, n_municipios, dtype=np.int32)
+    populacao_60_mais = rng.integers(1000, 150000, n_municipios, dtype=np.int32)
+    pib_per_capita = rng.uniform(8000, 45000, n_municipios).astype(np.float32)
+    regiao = rng.choice(np.array(['Norte', 'Nordeste', 'Sudeste', 'Sul', 'Centro-Oeste']), n_municipios)
+    
+    percentual_idosos = (populacao_60_mais / populacao_total) * 100
+    internacoes_por_1000 = percentual_idosos * 2 + rng.normal(0, 10, n_municipios)
+    procedimentos_por_1000 = pib_per_capita / 200 + rng.normal(0, 20, n_municipios)
+    
+    # Montar o DataFrame de uma vez, sem inserir colunas uma a uma
     dados = pd.DataFrame({
-        'codigo_ibge': range(100000, 100000 + n_municipios),
-        'municipio': [f'Município {i}' for i in range(1, n_municipios + 1)],
-        'populacao_total': np.random.randint(10000, 800000, n_municipios),
-        'populacao_60_mais': np.random.randint(1000, 150000, n_municipios),
-        'pib_per_capita': np.random.uniform(8000, 45000, n_municipios),
-        'regiao': np.random.choice(['Norte', 'Nordeste', 'Sudeste', 'Sul', 'Centro-Oeste'], n_municipios),
+        'codigo_ibge': np.arange(100000, 100000 + n_municipios, dtype=np.int32),
+        'municipio': np.char.add('Município ', np.arange(1, n_municipios + 1).astype(str)),
+        'populacao_total': populacao_total,
+        'populacao_60_mais': populacao_60_mais,
+        'pib_per_capita': pib_per_capita,
+        'regiao': pd.Categorical(regiao),
+        'percentual_idosos': percentual_idosos,
+        'internacoes_por_1000': internacoes_por_1000,
+        'procedimentos_por_1000': procedimentos_por_1000,
+        'gasto_internacao_per_capita': internacoes_por_1000 * 50,
     })
+    dados.set_index('codigo_ibge', inplace=True)
     
-    dados['percentual_idosos'] = (dados['populacao_60_mais'] / dados['populacao_total']) * 100
-    dados['internacoes_por_1000'] = dados['percentual_idosos'] * 2 + np.random.normal(0, 10, n_municipios)
-    dados['procedimentos_por_1000'] = dados['pib_per_capita'] / 200 + np.random.normal(0, 20, n_municipios)
-    dados['gasto_internacao_per_capita'] = dados['internacoes_por_1000'] * 50
+    return dados, calcular_limites(dados)
+
+# Redução de pontos para os gráficos de dispersão
+def reduzir_pontos(dados, x, y, n_max=2000):
+    """Amostra uniforme (semente fixa) de até n_max linhas com x e y válidos"""
+    vx = dados[x].to_numpy(dtype=np.float64)
+    vy = dados[y].to_numpy(dtype=np.float64)
+    posicoes = np.flatnonzero(np.isfinite(vx) & np.isfinite(vy))
+    if len(posicoes) <= n_max:
+        return dados
     
-    return dados
+    # Amostra sem reposição: mantém a distribuição e a correlação da nuvem,
+    # ao contrário de decimações que escolhem os extremos de cada faixa
+    amostra = np.random.default_rng(0).choice(posicoes, size=n_max, replace=False)
+    return dados.iloc[np.sort(amostra)]
 
 # Sidebar
 with st.sidebar:
@@ -171,11 +273,11 @@ engine = conectar_banco()
 
 if engine:
     with st.spinner('Conectando ao banco e carregando dados REAIS...'):
-        df = carregar_dados_reais(engine)
+        df, limites = carregar_dados_reais(engine)
     st.success("✅ Dados REAIS carregados do banco!")
 else:
     with st.spinner('Carregando dados de exemplo...'):
-        df = carregar_dados_exemplo()
+        df, limites = carregar_dados_exemplo()
     st.warning("⚠️ Usando dados de exemplo. Verifique a conexão com o banco.")
 
 # Resto do código (filtros, gráficos, dashboards) permanece IGUAL...
@@ -188,53 +290,68 @@ st.sidebar.header("🎛️ Filtros")
 if 'regiao' in df.columns:
     regioes = st.sidebar.multiselect(
         "Regiões",
-        options=df['regiao'].unique(),
-        default=df['regiao'].unique()
+        options=list(df['regiao'].cat.categories),
+        default=list(df['regiao'].cat.categories)
     )
 else:
     # Se não tiver região, criar uma coluna fictícia
-    df['regiao'] = 'Todos'
+    df['regiao'] = pd.Categorical(['Todos'] * len(df))
     regioes = ['Todos']
 
+idosos_min, idosos_max = limites['percentual_idosos']
+pib_min, pib_max = limites['pib_per_capita']
+
 faixa_idosos = st.sidebar.slider(
     "Faixa de % Idosos",
-    min_value=float(df['percentual_idosos'].min()),
-    max_value=float(df['percentual_idosos'].max()),
+    min_value=idosos_min,
+    max_value=idosos_max,
     value=(5.0, 25.0)
 )
 
 faixa_pib = st.sidebar.slider(
     "Faixa de PIB per Capita (R$)",
-    min_value=float(df['pib_per_capita'].min()),
-    max_value=float(df['pib_per_capita'].max()),
+    min_value=pib_min,
+    max_value=pib_max,
     value=(10000.0, 40000.0)
 )
 
 # Aplicar filtros
-df_filtrado = df[
-    (df['regiao'].isin(regioes)) &
-    (df['percentual_idosos'] >= faixa_idosos[0]) &
-    (df['percentual_idosos'] <= faixa_idosos[1]) &
-    (df['pib_per_capita'] >= faixa_pib[0]) &
-    (df['pib_per_capita'] <= faixa_pib[1])
-]
+# Máscara montada direto nos arrays NumPy, sem Series intermediárias
+idosos = df['percentual_idosos'].to_numpy()
+pib = df['pib_per_capita'].to_numpy()
+codigos_regiao = df['regiao'].cat.codes.to_numpy()
+regioes_permitidas = df['regiao'].cat.categories.get_indexer(regioes)
+mascara = (
+    np.isin(codigos_regiao, regioes_permitidas) &
+    (idosos >= faixa_idosos[0]) &
+    (idosos <= faixa_idosos[1]) &
+    (pib >= faixa_pib[0]) &
+    (pib <= faixa_pib[1])
+)
+df_filtrado = df.iloc[mascara]
 
 # METRICAS PRINCIPAIS
 st.header("📊 Visão Geral dos Municípios (Dados REAIS)")
 
+# As três médias numa única passada sobre o bloco de colunas
+populacao_media, idosos_medio, pib_medio = np.nanmean(
+    df_filtrado[['populacao_total', 'percentual_idosos', 'pib_per_capita']].to_numpy(dtype=np.float64),
+    axis=0
+)
+
 col1, col2, col3, col4 = st.columns(4)
 
 with col1:
     st.metric("Municípios Analisados", f"{len(df_filtrado):,}")
 
 with col2:
-    st.metric("População Média", f"{df_filtrado['populacao_total'].mean():,.0f}")
+    st.metric("População Média", f"{populacao_media:,.0f}")
 
 with col3:
-    st.metric("% Idosos Médio", f"{df_filtrado['percentual_idosos'].mean():.1f}%")
+    st.metric("% Idosos Médio", f"{idosos_medio:.1f}%")
 
 with col4:
-    st.metric("PIB per Capita Médio", f"R$ {df_filtrado['pib_per_capita'].mean():,.0f}")
+    st.metric("PIB per Capita Médio", f"R$ {pib_medio:,.0f}")
 
 # DASHBOARD 1: ANÁLISE DA PNAHP
 st.header("🏥 DASHBOARD 1: Análise PNAHP - Atenção Hospitalar")
@@ -243,7 +360,7 @@ col1, col2 = st.columns(2)
 
 with col1:
     fig = px.scatter(
-        df_filtrado,
+        reduzir_pontos(df_filtrado, 'percentual_idosos', 'internacoes_por_1000'),
         x='percentual_idosos',
         y='internacoes_por_1000',
         size='populacao_total',
@@ -252,21 +369,27 @@ with col1:
         labels={
             'percentual_idosos': '% População com 60+ anos',
             'internacoes_por_1000': 'Internações por 1000 habitantes'
-        }
+        },
+        render_mode='webgl'
     )
     st.plotly_chart(fig, use_container_width=True)
     
-    correlacao = df_filtrado['percentual_idosos'].corr(df_filtrado['internacoes_por_1000'])
+    # Pearson direto nos arrays, ignorando municípios sem internações registradas
+    a = df_filtrado['percentual_idosos'].to_numpy(dtype=np.float64)
+    b = df_filtrado['internacoes_por_1000'].to_numpy(dtype=np.float64)
+    validos = ~(np.isnan(a) | np.isnan(b))
+    correlacao = float(np.corrcoef(a[validos], b[validos])[0, 1]) if validos.sum() >= 2 else float('nan')
     st.metric("Correlação REAL", f"{correlacao:.3f}")
 
 with col2:
     fig = px.scatter(
-        df_filtrado,
+        reduzir_pontos(df_filtrado, 'pib_per_capita', 'gasto_internacao_per_capita'),
         x='pib_per_capita',
         y='gasto_internacao_per_capita',
         size='populacao_total',
         color='percentual_idosos',
-        title='Relação REAL: PIB vs Gastos Hospitalares'
+        title='Relação REAL: PIB vs Gastos Hospitalares',
+        render_mode='webgl'
     )
     st.plotly_chart(fig, use_container_width=True)
 